@@ -1,11 +1,25 @@
+# Patch blocking stdlib I/O before anything else imports socket/ssl, so outbound
+# requests yield to other greenlets instead of pinning a worker thread.
+from gevent import monkey
+monkey.patch_all()
+
 import os
 import random
 import requests
 import logging
 import json
 import re
-from flask import Flask, request, jsonify
-from urllib.parse import urlparse, quote
+import string
+import hashlib
+import threading
+import time
+import orjson
+from collections import OrderedDict
+from flask import Flask, Response, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote
+from gevent.pool import Pool
 
 # ================== LOGGING ===================
 logging.basicConfig(
@@ -25,195 +39,254 @@ logger.info("Inference URL: %s", INFERENCE_URL)
 logger.info("Inference MODEL: %s", INFERENCE_MODEL_ID)
 logger.info("Inference KEY set: %s", bool(INFERENCE_KEY))
 
+INFERENCE_ENDPOINT = f"{INFERENCE_URL}/v1/chat/completions"
+INFERENCE_HEADERS = {
+    "Authorization": f"Bearer {INFERENCE_KEY}",
+    "Content-Type": "application/json"
+}
+INFERENCE_PAYLOAD_BASE = {"model": INFERENCE_MODEL_ID}
+# Chat replies are cut to 200 chars anyway; analysis needs room for the JSON object.
+# Capping generation per action keeps short replies from paying for long tails.
+INFERENCE_MAX_TOKENS = {
+    "analyze": int(os.getenv("INFERENCE_MAX_TOKENS_ANALYZE", 400)),
+    "chat": int(os.getenv("INFERENCE_MAX_TOKENS_CHAT", 120)),
+}
+# Only the prompt text changes between calls, so serialize everything around it once.
+INFERENCE_PAYLOAD_HEADS = {
+    action: orjson.dumps(dict(INFERENCE_PAYLOAD_BASE, max_tokens=max_tokens))[:-1]
+    + b',"messages":[{"role":"system","content":'
+    for action, max_tokens in INFERENCE_MAX_TOKENS.items()
+}
+INFERENCE_PAYLOAD_USER = b'},{"role":"user","content":'
+INFERENCE_PAYLOAD_TAIL = b'}]}'
+
+
+def build_inference_body(system_prompt, user_prompt, action):
+    return b"".join((
+        INFERENCE_PAYLOAD_HEADS[action], orjson.dumps(system_prompt),
+        INFERENCE_PAYLOAD_USER, orjson.dumps(user_prompt),
+        INFERENCE_PAYLOAD_TAIL
+    ))
+
+# Upper bounds on what is kept from each client-supplied history block sent to the model.
+MAX_CONTEXT_LINES = int(os.getenv("MAX_CONTEXT_LINES", 50))
+MAX_CONTEXT_CHARS = int(os.getenv("MAX_CONTEXT_CHARS", 4000))
+
+# ================== HTTP CLIENT ===================
+# One pooled session for every outbound call (auth, active users, inference) so
+# keep-alive sockets and TLS sessions are reused instead of re-handshaking per request.
+HTTP = requests.Session()
+# Retry only failed connects and 502/503/504 answers. Read timeouts are not retried
+# (read=0): that would multiply each call's read timeout. urllib3 never retries POST,
+# so the inference call is not retried on 5xx either.
+_http_adapter = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=256,
+    max_retries=Retry(total=2, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+)
+HTTP.mount("https://", _http_adapter)
+HTTP.mount("http://", _http_adapter)
+# Fail fast on DNS/TCP/TLS stalls; read timeouts stay per call.
+CONNECT_TIMEOUT = 3.05
+
+# Runs independent outbound lookups in sibling greenlets of the request. Each request
+# spawns at most two, so size the pool for twice gunicorn's --worker-connections (1000);
+# a small fixed pool would queue lookups behind each other.
+BACKGROUND = Pool(int(os.getenv("BACKGROUND_GREENLETS", 2000)))
+# ==============================================
+
 # ================== COUNTRY CONFIGURATION ===================
 COUNTRY_CONFIG = {
     "de": {
         "lang": "German (Deutsch) - Street Slang",
         "vibe": "Young German gambler. Uses 'Digga', 'Alter', 'Safe', 'Junge', 'Lost', 'Wyld'. Writes in lowercase mostly.",
-        "questions": [
+        "questions": (
             "digga was geht heute?", "komplett lost heute...", "jemand am gewinnen?", 
             "digga dieser slot ist tot", "alter was ein pech"
-        ]
+        )
     },
     "tr": {
         "lang": "Turkish (Türkçe)",
         "vibe": "Turkish gambler. Uses 'Abi', 'Kral', 'Hocam', 'Lan' (casually), 'Vallah'. Emotional and loud.",
-        "questions": [
+        "questions": (
             "abi bu ne ya?", "kral taktik var mı?", "bugün kasa eridi resmen", 
             "vallah battık beyler", "selam beyler durumlar ne"
-        ]
+        )
     },
     "pt": {
         "lang": "Portuguese (Português - Brazil)",
         "vibe": "Brazilian gambler. Uses 'Mano', 'Velho', 'Nossa', 'Top', 'Zica'. Casual and friendly.",
-        "questions": [
+        "questions": (
             "e aí mano tudo certo?", "nossa que azar hoje", "alguém forrando?", 
             "hoje tá osso", "bora recuperar galera"
-        ]
+        )
     },
     "en": {
         "lang": "Casual English",
         "vibe": "Bored gambler. Uses 'bruh', 'lol', 'rip', 'gg', 'scam', 'dry'. mostly lowercase.",
-        "questions": [
+        "questions": (
             "yo any huge wins?", "rip my balance lol", "site is so dry rn", 
             "bruh this game is rigged", "gl everyone"
-        ]
+        )
     },
     "us": {
         "lang": "American English",
         "vibe": "US gambler. Uses 'bro', 'dude', 'wild', 'fr', 'no cap', 'bet'.",
-        "questions": [
+        "questions": (
             "yo what's good chat", "bro i'm down bad", "anyone printing?", 
             "this is wild fr", "let's get it"
-        ]
+        )
     },
     "uk": {
         "lang": "British English",
         "vibe": "UK Lad. Uses 'mate', 'innit', 'bruv', 'proper', 'dead'.",
-        "questions": [
+        "questions": (
             "alright lads?", "proper dead today innit", "any luck mates?", 
             "cheers for the luck", "bit quiet yeah?"
-        ]
+        )
     },
     "ph": {
         "lang": "Tagalog / Taglish",
         "vibe": "Filipino gambler. Uses 'lods', 'pre', 'awit', 'sana all', 'olats'.",
-        "questions": [
+        "questions": (
             "kamusta mga lods", "awit talo na naman", "sana all nananalo", 
             "pre ano laro ngayon?", "may swerte ba?"
-        ]
+        )
     },
     "jp": {
         "lang": "Japanese (Casual/Slang)",
         "vibe": "Japanese gambler. Uses 'maji', 'yabai', 'w', 'kusa', 'gachi'.",
-        "questions": [
+        "questions": (
             "みんな調子どう？", "まじで勝てんw", "やばい、溶けた...", 
             "誰か当たりきてる？", "今日はダメかもw"
-        ]
+        )
     },
     "pl": {
         "lang": "Polish (Polski)",
         "vibe": "Polish gambler. Uses 'kurde', 'siema', 'masakra', 'ja pier...', 'lol'.",
-        "questions": [
+        "questions": (
             "siema pany jak idzie", "kurde ale lipa dzisiaj", "wygrał ktoś coś?", 
             "masakra z tym slotem", "powodzenia all"
-        ]
+        )
     },
     "th": {
         "lang": "Thai",
         "vibe": "Thai gambler. Uses '555' (laugh), 'sad', 'su su'.",
-        "questions": [
+        "questions": (
             "วันนี้เป็นไงบ้างครับ", "หมดตัวแล้ว 555", "มีใครบวกบ้าง", 
             "สู้ๆ นะทุกคน", "วันนี้เงียบจัง"
-        ]
+        )
     },
     "kr": {
         "lang": "Korean (Casual)",
         "vibe": "Korean gambler. Uses 'zz', 'keke', 'hul', 'shibal' (softly).",
-        "questions": [
+        "questions": (
             "형님들 오늘 어때요?", "아이고 다 잃었네...", "대박 터진 분?", 
             "오늘 너무 안되네요 ㅠㅠ", "다들 ㅎㅇㅌ"
-        ]
+        )
     },
     "ru": {
         "lang": "Russian (Slang)",
         "vibe": "Russian gambler. Uses 'brat', 'blin', 'gg', 'scam', 'zaebal'.",
-        "questions": [
+        "questions": (
             "ку всем, как оно?", "блин все слил", "есть живые?", 
             "удачи пацаны", "сегодня не мой день"
-        ]
+        )
     },
     "vn": {
         "lang": "Vietnamese",
         "vibe": "Vietnamese gambler. Uses 'bac', 'vl', 'vai', 'chan', 'anh em'.",
-        "questions": [
+        "questions": (
             "chào anh em, nay thế nào", "vãi thật thua hết rồi", "có ai về bờ không", 
             "chán quá game hút máu", "chúc ae may mắn"
-        ]
+        )
     },
     "fi": {
         "lang": "Finnish",
         "vibe": "Finnish gambler. Uses 'moi', 'vittu' (lightly), 'perkele', 'noni'.",
-        "questions": [
+        "questions": (
             "moi kaikille", "voi ei taas meni rahat", "onko voittoja?", 
             "perkele kun ei osu", "gl kaikille"
-        ]
+        )
     },
     "es": {
         "lang": "Spanish (Latam/Spain)",
         "vibe": "Latino gambler. Uses 'tio', 'bro', 'joder', 'no mames', 'vamos'.",
-        "questions": [
+        "questions": (
             "que tal gente", "hoy perdi todo bro", "alguien ganando?", 
             "vamos con todo", "mucha suerte"
-        ]
+        )
     },
     "ng": {
         "lang": "Nigerian Pidgin",
         "vibe": "Naija gambler. Uses 'Abeg', 'How far', 'No wahala', 'Omo', 'Dey', 'Sabi'. Very expressive.",
-        "questions": [
+        "questions": (
             "how far my people?", "omo i don lose money o", "who dey win for here?", 
             "abeg show love na", "this game no dey smile"
-        ]
+        )
     },
     "ar": {
         "lang": "Arabic (Chat/Arabizi)",
         "vibe": "Arabic gambler. Uses 'shabab', 'wallah', 'haram', 'yallah'.",
-        "questions": [
+        "questions": (
             "salam shabab keef al hal", "wallah khasirt kul shi", "mabrook lil rabihin", 
             "yallah nshoof al huth", "wein al nas alyom"
-        ]
+        )
     },
     "ae": {
         "lang": "Arabic",
         "vibe": "Arabic gambler (Gulf). Uses 'Habibi', 'Salam', 'Yallah', 'Wallah'.",
-        "questions": [
+        "questions": (
             "salam shabab", "wallah lost it all", "any winners?",
             "yallah nshoof al huth", "wein al nas alyom"
-        ]
+        )
     },
     "no": {
         "lang": "Norwegian",
         "vibe": "Norwegian gambler. Uses 'faen', 'uff', 'jaja'.",
-        "questions": [
+        "questions": (
             "hei folkens", "uff tapte alt i dag", "noen som vinner?", 
             "lykke til alle", "stille i chatten"
-        ]
+        )
     },
     "id": {
         "lang": "Indonesian (Bahasa Gaul)",
         "vibe": "Indo gambler. Uses 'gan', 'bang', 'anjir', 'wkwk', 'rungkad', 'gacor'.",
-        "questions": [
+        "questions": (
             "halo gan gimana?", "aduh rungkad bos", "mantap yang jp", 
             "sepi amat ya", "gas terus bang"
-        ]
+        )
     },
     "pk": {
         "lang": "Urdu/English (Roman Urdu)",
         "vibe": "Pakistani street smart gambler. Uses 'Jani', 'Bhai', 'Scene', 'Khair hai', 'Bachao'. Abbr: 'kya', 'n', 'thx'.",
-        "questions": [
+        "questions": (
             "kya scene hai boys?", "aaj bohot loss hua yaar", "koi jeeta kya aaj?", 
             "salam bhai log", "maza nahi aa raha aaj"
-        ]
+        )
     },
     "cn": {
         "lang": "Chinese (Casual)",
         "vibe": "Chinese gambler. Uses 'nb', '666', 'tmd' (carefully), 'haha'.",
-        "questions": [
+        "questions": (
             "大家好", "哎呀输惨了", "有人赢吗", "666运气真好", "加油"
-        ]
+        )
     },
     "in": {
         "lang": "Hinglish (Indian Casual)",
         "vibe": "Authentic Desi gambler. Uses 'Bhai', 'Yaar', 'Arre', 'Mast', 'Sahi hai', 'Lagg gaye'. Casual, uses 'tu' not 'aap'. Abbr: 'kya', 'n', 'h', 'thx'.",
-        "questions": [
+        "questions": (
             "kya bolti public", "aaj 500 ka loss ho gaya yaar", "koi tips hai kya", 
             "bhai log kya scene hai", "sahi hai boss"
-        ]
+        )
     }
 }
 
 DEFAULT_CONFIG = COUNTRY_CONFIG["en"]
 
+# Dedicated PRNG so question picks don't go through the shared module-level instance.
+_pick_question = random.Random().choice
+
 SAFETY_INSTRUCTIONS = """
 CRITICAL RULES:
 1. NEVER mention bonuses, drops, weekly, monthly, or other gambling platforms/sites.
@@ -243,41 +316,63 @@ Core Personality:
 IMPORTANT: You MUST speak in {lang}. Do not sound like a robot.
 """
 
+# Persona text only depends on the country (username stays a literal placeholder),
+# so render it once per country instead of on every request.
+COUNTRY_PERSONAS = {
+    code: PERSONA_TEMPLATE.format(lang=cfg["lang"], vibe=cfg["vibe"])
+    for code, cfg in COUNTRY_CONFIG.items()
+}
 
-ANALYSIS_PROMPT = """
-You are analyzing a casino chat to understand the social dynamics.
-Your username is {username}.
 
-Based on these recent chat messages:
-{recent_messages}
-
-And your bot's recent messages:
-{bot_messages}
+# Prompts are split into a static system part (persona, rules, output format) and a
+# per-request user part (chat state, history). Keeping every dynamic field after the
+# identical prefix lets the inference provider reuse its prompt-prefix cache.
+ANALYSIS_SYSTEM_PROMPT = """
+You are analyzing a casino chat to understand the social dynamics.
 
 IMPORTANT: ONLY RETURN A SINGLE VALID JSON OBJECT. DO NOT INCLUDE ANY MARKDOWN, CODE-FENCES (```), OR ANY EXPLANATORY TEXT.
-START IMMEDIATELY WITH THE JSON OBJECT (the very first character MUST be '{{').
+START IMMEDIATELY WITH THE JSON OBJECT (the very first character MUST be '{').
 
 Your JSON must match this structure exactly:
-{{
+{
   "vibe": "dead|slow|active|chaotic|tilt|happy|argument|flex|bonus-wait",
   "topics": "brief summary of main topics being discussed",
-  "userInterest": {{
+  "userInterest": {
     "activeUsers": ["user1", "user2"],
     "friendlyUsers": ["user1", "user3"],
     "toxicUsers": ["user4"],
     "spammingUsers": ["user5"]
-  }},
+  },
   "relationshipState": "brief description of how users perceive your bot",
   "behaviourProfile": "aggressive|calm|friendly|sarcastic",
   "contextMemoryBlob": "max 200 character compressed memory of the current chat state"
-}}
+}
 
 Focus on accuracy and brevity.
 ONLY return valid JSON.
 """
 
-INACTIVITY_PROMPT = """
+ANALYSIS_PROMPT = """{avoid_block}
+Your username is {username}.
+
+Based on these recent chat messages:
+{recent_messages}
+
+And your bot's recent messages:
+{bot_messages}
+"""
+
+INACTIVITY_SYSTEM_PROMPT = """
 {persona}
+{safety}
+
+It's been a long time since someone talked to u. Send a message to wake up the chat.
+Keep it very short (max 8-10 words). Don't explain anything.
+Be casual, use slang.
+Language: {lang}
+"""
+
+INACTIVITY_PROMPT = """{avoid_block}
 Current chat context:
 - Vibe: {vibe}
 - Topics: {topics}
@@ -285,12 +380,6 @@ Current chat context:
 - Memory: {memory}
 - Your emotional state: {emotional_state} ({emotional_word})
 {mod_warning}
-{safety}
-
-It's been a long time since someone talked to u. Send a message to wake up the chat.
-Keep it very short (max 8-10 words). Don't explain anything.
-Be casual, use slang.
-Language: {lang}
 
 Here are your previous messages for context:
 {bot_history}
@@ -301,16 +390,8 @@ IMPORTANT: DO NOT REPEAT any of these messages you've sent before:
 Your response:
 """
 
-MENTION_PROMPT = """
+MENTION_SYSTEM_PROMPT = """
 {persona}
-Current chat context:
-- Vibe: {vibe}
-- Topics: {topics}
-- Your behavior profile: {behaviour_profile}
-- Memory: {memory}
-- Your emotional state: {emotional_state} ({emotional_word})
-{specific_context}
-{mod_warning}
 {safety}
 
 Reply to each user who mentioned you by tagging them with @username. 
@@ -320,6 +401,17 @@ Act like a real human by making some intentional spelling mistakes and using cas
 Don't use emojies excessively. and reply to max 2 users at once only ignore rest
 Keep each reply very short - maximum 5-6 words.
 Language: {lang}
+"""
+
+MENTION_PROMPT = """{avoid_block}
+Current chat context:
+- Vibe: {vibe}
+- Topics: {topics}
+- Your behavior profile: {behaviour_profile}
+- Memory: {memory}
+- Your emotional state: {emotional_state} ({emotional_word})
+{specific_context}
+{mod_warning}
 
 Here are your previous messages for context:
 {bot_history}
@@ -333,8 +425,17 @@ IMPORTANT: DO NOT REPEAT any of these messages you've sent before:
 Your response (format: @user message):
 """
 
-GENERAL_TAG_PROMPT = """
+GENERAL_TAG_SYSTEM_PROMPT = """
 {persona}
+{safety}
+
+Select a message of a user and reply to that specific user by tagging them with @username (no parentheses).
+Based on these chat messages, respond with something VERY SHORT - maximum 5-6 words only. Don't explain anything.
+Act like a real human by making some intentional spelling mistakes and using casual language.
+Language: {lang}
+"""
+
+GENERAL_TAG_PROMPT = """{avoid_block}
 Current chat context:
 - Vibe: {vibe}
 - Topics: {topics}
@@ -342,12 +443,6 @@ Current chat context:
 - Memory: {memory}
 - Your emotional state: {emotional_state} ({emotional_word})
 {mod_warning}
-{safety}
-
-Select a message of a user and reply to that specific user by tagging them with @username (no parentheses).
-Based on these chat messages, respond with something VERY SHORT - maximum 5-6 words only. Don't explain anything.
-Act like a real human by making some intentional spelling mistakes and using casual language.
-Language: {lang}
 
 Here are your previous messages for context:
 {bot_history}
@@ -361,8 +456,17 @@ IMPORTANT: DO NOT REPEAT any of these messages you've sent before:
 Your response (start with @username):
 """
 
-GENERAL_NO_TAG_PROMPT = """
+GENERAL_NO_TAG_SYSTEM_PROMPT = """
 {persona}
+{safety}
+
+Do not tag anyone.
+Keep it short (max 8-10 words).
+Act like a real human by making some intentional spelling mistakes.
+Language: {lang}
+"""
+
+GENERAL_NO_TAG_PROMPT = """{avoid_block}
 Current chat context:
 - Vibe: {vibe}
 - Topics: {topics}
@@ -370,13 +474,8 @@ Current chat context:
 - Memory: {memory}
 - Your emotional state: {emotional_state} ({emotional_word})
 {mod_warning}
-{safety}
 
 Ask a general question or make a statement like "{random_question}". 
-Do not tag anyone.
-Keep it short (max 8-10 words).
-Act like a real human by making some intentional spelling mistakes.
-Language: {lang}
 
 Here are your previous messages for context:
 {bot_history}
@@ -390,17 +489,90 @@ IMPORTANT: DO NOT REPEAT any of these messages you've sent before:
 Your response:
 """
 
+def compile_prompt(template):
+    """
+    Split a str.format template once into (literal, field) pairs so requests only
+    have to join strings instead of re-parsing the template on every call.
+    """
+    return tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(template))
+
+
+def render_prompt(parts, context):
+    return "".join([
+        literal if field is None else literal + str(context[field])
+        for literal, field in parts
+    ])
+
+
+def render_system_prompts(template):
+    """Render a chat system prompt for every country; all of its fields are fixed text."""
+    return {
+        code: template.format(persona=COUNTRY_PERSONAS[code], safety=SAFETY_INSTRUCTIONS, lang=cfg["lang"])
+        for code, cfg in COUNTRY_CONFIG.items()
+    }
+
+
+ANALYSIS_PARTS = compile_prompt(ANALYSIS_PROMPT)
+
+# Chat mode -> (system prompt per country, user prompt parts); unknown modes fall
+# back to a general untagged message.
+CHAT_PROMPTS = {
+    "inactivity": (render_system_prompts(INACTIVITY_SYSTEM_PROMPT), compile_prompt(INACTIVITY_PROMPT)),
+    "mention": (render_system_prompts(MENTION_SYSTEM_PROMPT), compile_prompt(MENTION_PROMPT)),
+    "general_tag": (render_system_prompts(GENERAL_TAG_SYSTEM_PROMPT), compile_prompt(GENERAL_TAG_PROMPT)),
+    "general_no_tag": (render_system_prompts(GENERAL_NO_TAG_SYSTEM_PROMPT), compile_prompt(GENERAL_NO_TAG_PROMPT)),
+}
+
+# ================== OUTPUT FILTERS ===================
+# Raw completions are cut to this many chars before cleanup; the margin over the
+# 200-char reply cap leaves room for lines the filters below drop.
+RAW_OUTPUT_LIMIT = 2000
+EMOJI_RE = re.compile(
+    "["u"\U0001F600-\U0001F64F"
+    u"\U0001F300-\U0001F5FF"
+    u"\U0001F680-\U0001F6FF"
+    u"\U0001F1E0-\U0001F1FF"
+    u"\u2600-\u26FF\u2700-\u27BF"
+    "]+",
+    flags=re.UNICODE
+)
+AI_DISCLAIMER_RE = re.compile(r"^(?:As an AI|I'm an AI|I am an AI).*?\s*", re.I)
+PAREN_MENTION_RE = re.compile(r'@\(([^)]+)\)')
+MODERATOR_LINE_RE = re.compile(r'\[MODERATOR\]|\bmoderator\b|\bmod\b', re.I)
+AI_TAG_LINE_RE = re.compile(r'^\s*ai[:\s]', re.I)
+COMMAND_RE = re.compile(r'\bcommand\b', re.I)
+TIME_REF_RE = re.compile(r'\blast night\b|\byesterday\b|\bthis morning\b|\btoday\b', re.I)
+# ==============================================
+
+def json_response(payload, status=200):
+    """Serialize with orjson and skip Flask's jsonify provider on every response."""
+    return Response(orjson.dumps(payload), status=status, mimetype="application/json")
+
+
 def is_allowed_origin(origin):
     if not origin:
         return False
     if origin.startswith("chrome-extension://"):
         return True
-    try:
-        parsed = urlparse(origin)
-        host = parsed.hostname.lower() if parsed.hostname else ""
-        return host.startswith("stake")
-    except:
+    # An Origin header is just scheme://host[:port], so slice the host out directly
+    # instead of running urlparse on every response.
+    scheme_end = origin.find("://")
+    if scheme_end <= 0:
         return False
+    host = origin[scheme_end + 3:].split("/", 1)[0]
+    # Drop any userinfo and port, as urlparse's hostname would.
+    host = host.rpartition("@")[2].split(":", 1)[0]
+    return host.lower().startswith("stake")
+
+
+@app.before_request
+def answer_preflight():
+    # Preflights carry no body to handle: reply before view dispatch and let
+    # add_cors_headers attach the allow headers. Max-Age lets browsers skip repeats.
+    if request.method == "OPTIONS":
+        response = Response(status=204)
+        response.headers["Access-Control-Max-Age"] = "86400"
+        return response
 
 
 @app.after_request
@@ -421,9 +593,9 @@ def get_active_usernames():
     try:
         active_url = "https://chat-auth-75bd02aa400a.herokuapp.com/active_users"
         logger.info("Fetching active users: %s", active_url)
-        res = requests.get(active_url, timeout=5)
+        res = HTTP.get(active_url, timeout=(CONNECT_TIMEOUT, 5))
         res.raise_for_status()
-        payload = res.json()
+        payload = orjson.loads(res.content)
         users = []
         for item in payload.get("active_users", []):
             uname = item.get("username")
@@ -446,6 +618,148 @@ def get_active_usernames():
         logger.warning("Failed to fetch active users: %s", e)
         return []
 
+# ----------------- New helper: short-lived cache of auth check results -----------------
+AUTH_CACHE_SIZE = 4096
+AUTH_CACHE_TTL = 120
+# Unknown users are re-checked sooner so a newly registered user is not locked out for long.
+AUTH_CACHE_NEGATIVE_TTL = 10
+# A known user stays authorized this long past expiry if the auth service is failing.
+AUTH_CACHE_STALE_GRACE = 600
+_auth_cache = OrderedDict()
+_auth_cache_lock = threading.Lock()
+
+
+def get_cached_auth(user):
+    """
+    Return the cached auth result for `user` (True/False), or None when the user has
+    not been checked recently and the auth service must be asked.
+    """
+    with _auth_cache_lock:
+        entry = _auth_cache.get(user)
+        if entry is None:
+            return None
+        expires_at, exists = entry
+        now = time.monotonic()
+        if expires_at <= now:
+            # Keep expired positives around for recently_authorized() until the grace runs out.
+            if not exists or expires_at + AUTH_CACHE_STALE_GRACE <= now:
+                del _auth_cache[user]
+            return None
+        _auth_cache.move_to_end(user)
+        return exists
+
+
+def recently_authorized(user):
+    """
+    True if `user` passed the auth check within the stale grace window. Used to ride out
+    auth service failures instead of rejecting users who were known to be valid.
+    """
+    with _auth_cache_lock:
+        entry = _auth_cache.get(user)
+    if entry is None:
+        return False
+    expires_at, exists = entry
+    return exists and expires_at + AUTH_CACHE_STALE_GRACE > time.monotonic()
+
+
+def store_cached_auth(user, exists):
+    ttl = AUTH_CACHE_TTL if exists else AUTH_CACHE_NEGATIVE_TTL
+    with _auth_cache_lock:
+        _auth_cache[user] = (time.monotonic() + ttl, exists)
+        _auth_cache.move_to_end(user)
+        if len(_auth_cache) > AUTH_CACHE_SIZE:
+            _auth_cache.popitem(last=False)
+
+def check_user_auth(user):
+    """
+    Ask the auth service whether `user` exists and cache the answer. Raises on network or
+    HTTP errors so the caller can decide whether a recent result is good enough.
+    """
+    name = user[1:]
+    # Plain ASCII usernames need no escaping beyond the leading "@" (quote() gives "%40").
+    encoded_user = "%40" + name if name.isascii() and name.isalnum() else quote(user)
+    # ✅ AUTH CHECK (FIXED URL ONLY)
+    auth_url = f"https://chat-auth-75bd02aa400a.herokuapp.com/check?user={encoded_user}"
+    logger.info("Auth check: %s", auth_url)
+
+    auth_res = HTTP.get(auth_url, timeout=(CONNECT_TIMEOUT, 10))
+    auth_res.raise_for_status()
+
+    auth_data = orjson.loads(auth_res.content)
+    logger.info("Auth response: %s", auth_data)
+
+    user_exists = bool(auth_data.get("exists"))
+    store_cached_auth(user, user_exists)
+    return user_exists
+
+
+def _auth_check_job(user):
+    # Hand failures back as a value: an exception escaping a greenlet is also printed by
+    # gevent's hub, which would log every auth outage twice.
+    try:
+        return check_user_auth(user)
+    except Exception as e:
+        return e
+
+# ----------------- New helper: keep only the most recent lines of a context block -----------------
+def tail_lines(text, limit=MAX_CONTEXT_LINES, max_chars=MAX_CONTEXT_CHARS):
+    """
+    Return the last `limit` lines of a chat/history block, then at most its last
+    `max_chars` characters, so prompt size stays bounded no matter how much history the
+    client sends (one huge line included). Non-string values pass through untouched.
+    """
+    if not isinstance(text, str):
+        return text
+    parts = text.rsplit("\n", limit)
+    if len(parts) > limit:
+        text = "\n".join(parts[1:])
+    if len(text) > max_chars:
+        text = text[-max_chars:]
+    return text
+
+# ----------------- New helper: in-process cache of cleaned inference output -----------------
+RESPONSE_CACHE_SIZE = 4096
+# Chat moves on quickly, so a cached reply is only reused for a few minutes.
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 300))
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def response_cache_key(user, action, system_prompt, user_prompt):
+    """
+    Identical prompts (same country, mode and chat context) produce interchangeable
+    replies for the same account, so key the cache on a short digest of the user, the
+    action and both prompts. Chat prompts carry no username, and without it accounts
+    sharing a room would all post the same cached reply.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (user, action, system_prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(user_prompt.encode("utf-8"))
+    return digest.digest()
+
+
+def get_cached_response(key):
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, output = entry
+        if expires_at <= time.monotonic():
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return output
+
+
+def store_cached_response(key, output):
+    with _response_cache_lock:
+        _response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, output)
+        _response_cache.move_to_end(key)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
 # -----------------------------------------------------------------------------------------------
 
 @app.route("/<country_code>", methods=["POST", "GET"])
@@ -453,182 +767,141 @@ def handle_country_request(country_code):
     logger.info("Incoming %s %s for Country: %s", request.method, request.path, country_code)
 
     if request.method == "GET":
-        return jsonify({"error": "Please use POST with JSON body"}), 405
+        return json_response({"error": "Please use POST with JSON body"}, 405)
 
     country_code = country_code.lower()
     config = COUNTRY_CONFIG.get(country_code)
 
     if not config:
-        return jsonify({"error": f"Country code '{country_code}' not supported."}), 404
+        return json_response({"error": f"Country code '{country_code}' not supported."}, 404)
 
-    payload = request.json
-    if not payload:
-        return jsonify({"error": "Missing JSON body"}), 400
+    try:
+        payload = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        payload = None
+    # Valid JSON that is not an object ([1], "x") is as unusable as no body at all.
+    if not payload or not isinstance(payload, dict):
+        return json_response({"error": "Missing JSON body"}, 400)
 
     user = payload.get("user")
     action = payload.get("action")
     data = payload.get("data", {})
 
     if not user:
-        return jsonify({"error": "Missing user"}), 400
-
+        return json_response({"error": "Missing user"}, 400)
+    if not isinstance(user, str):
+        return json_response({"error": "Invalid user"}, 400)
+    if not isinstance(data, dict):
+        return json_response({"error": "Invalid data"}, 400)
 
-    # ✅ AUTH CHECK (FIXED URL ONLY)
-    try:
-        if not user.startswith("@"):
-            user = "@" + user
+    if user[:1] != "@":
+        user = "@" + user
 
-        encoded_user = quote(user)
-        auth_url = f"https://chat-auth-75bd02aa400a.herokuapp.com/check?user={encoded_user}"
-        logger.info("Auth check: %s", auth_url)
+    user_exists = get_cached_auth(user)
+    if user_exists is False:
+        return json_response({"error": "Unauthorized user"}, 403)
 
-        auth_res = requests.get(auth_url, timeout=10)
-        auth_res.raise_for_status()
-
-        auth_data = auth_res.json()
-        logger.info("Auth response: %s", auth_data)
-
-        if not auth_data.get("exists"):
-            return jsonify({"error": "Unauthorized user"}), 403
-
-    except Exception as e:
-        logger.exception("Auth API failure")
-        return jsonify({"error": "Auth API failure", "details": str(e)}), 500
-
-
-    final_prompt = ""
-    
-    persona_filled = PERSONA_TEMPLATE.format(
-        lang=config["lang"],
-        vibe=config["vibe"],
-        username=user
-    )
+    # Neither the auth check nor the active-users list depends on the other, and the prompt
+    # only needs the latter, so run both lookups while the prompt is being built.
+    auth_job = None if user_exists is not None else BACKGROUND.spawn(_auth_check_job, user)
+    active_users_job = BACKGROUND.spawn(get_active_usernames)
 
     # ----------------- fetch active users and build avoid block -----------------
-    active_usernames = get_active_usernames()
+    active_usernames = active_users_job.get()
     avoid_block = ""
     if active_usernames:
         # Join with spaces so model sees them as separate tokens/usernames
         avoid_block = "Avoid tagging or replying to these active users: " + " ".join(active_usernames) + "\n\n"
     # ---------------------------------------------------------------------------
 
+    # An unknown action is only reported once the user is known to be authorized.
+    invalid_action = False
     if action == "analyze":
-        final_prompt = avoid_block + ANALYSIS_PROMPT.format(
-            username=user,
-            recent_messages=data.get("recent_messages", ""),
-            bot_messages=data.get("bot_messages", "")
-        )
+        system_prompt = ANALYSIS_SYSTEM_PROMPT
+        final_prompt = render_prompt(ANALYSIS_PARTS, {
+            "username": user,
+            "avoid_block": avoid_block,
+            "recent_messages": tail_lines(data.get("recent_messages", "")),
+            "bot_messages": tail_lines(data.get("bot_messages", ""))
+        })
 
     elif action == "chat":
-        vibe = data.get("vibe", "neutral")
-        topics = data.get("topics", "none")
-        behaviour = data.get("behaviour_profile", "friendly")
-        memory = data.get("memory", "none")
-        e_state = data.get("emotional_state", "neutral")
-        e_word = data.get("emotional_word", "")
-        mod_warning = data.get("mod_warning", "")
-        bot_history = data.get("bot_history", "")
-        last_bot_msgs = data.get("last_bot_messages_raw", "")
-        recent_msgs = data.get("formatted_messages", "")
-
         mode = data.get("mode", "general_no_tag")
-
-        if mode == "inactivity":
-            final_prompt = avoid_block + INACTIVITY_PROMPT.format(
-                persona=persona_filled,
-                vibe=vibe, topics=topics, behaviour_profile=behaviour,
-                memory=memory, emotional_state=e_state, emotional_word=e_word,
-                mod_warning=mod_warning, safety=SAFETY_INSTRUCTIONS,
-                bot_history=bot_history, last_bot_messages=last_bot_msgs,
-                lang=config["lang"]
-            )
-
-        elif mode == "mention":
-            final_prompt = avoid_block + MENTION_PROMPT.format(
-                persona=persona_filled,
-                vibe=vibe, topics=topics, behaviour_profile=behaviour,
-                memory=memory, emotional_state=e_state, emotional_word=e_word,
-                specific_context=data.get("specific_context", ""),
-                mod_warning=mod_warning, safety=SAFETY_INSTRUCTIONS,
-                bot_history=bot_history,
-                recent_messages=recent_msgs,
-                last_bot_messages=last_bot_msgs,
-                lang=config["lang"]
-            )
-
-        elif mode == "general_tag":
-            final_prompt = avoid_block + GENERAL_TAG_PROMPT.format(
-                persona=persona_filled,
-                vibe=vibe, topics=topics, behaviour_profile=behaviour,
-                memory=memory, emotional_state=e_state, emotional_word=e_word,
-                mod_warning=mod_warning, safety=SAFETY_INSTRUCTIONS,
-                bot_history=bot_history,
-                recent_messages=recent_msgs,
-                last_bot_messages=last_bot_msgs,
-                lang=config["lang"]
-            )
-
-        else:
-            rand_q = random.choice(config["questions"])
-            
-            final_prompt = avoid_block + GENERAL_NO_TAG_PROMPT.format(
-                persona=persona_filled,
-                vibe=vibe, topics=topics, behaviour_profile=behaviour,
-                memory=memory, emotional_state=e_state, emotional_word=e_word,
-                mod_warning=mod_warning, safety=SAFETY_INSTRUCTIONS,
-                random_question=rand_q,
-                bot_history=bot_history,
-                recent_messages=recent_msgs,
-                last_bot_messages=last_bot_msgs,
-                lang=config["lang"]
-            )
+        system_prompts, template = CHAT_PROMPTS.get(mode, CHAT_PROMPTS["general_no_tag"])
+        system_prompt = system_prompts[country_code]
+
+        prompt_context = {
+            "vibe": data.get("vibe", "neutral"),
+            "topics": data.get("topics", "none"),
+            "behaviour_profile": data.get("behaviour_profile", "friendly"),
+            "memory": data.get("memory", "none"),
+            "emotional_state": data.get("emotional_state", "neutral"),
+            "emotional_word": data.get("emotional_word", ""),
+            "mod_warning": data.get("mod_warning", ""),
+            "specific_context": data.get("specific_context", ""),
+            "bot_history": tail_lines(data.get("bot_history", "")),
+            "last_bot_messages": tail_lines(data.get("last_bot_messages_raw", "")),
+            "recent_messages": tail_lines(data.get("formatted_messages", "")),
+            "avoid_block": avoid_block,
+        }
+        if system_prompts is CHAT_PROMPTS["general_no_tag"][0]:
+            prompt_context["random_question"] = _pick_question(config["questions"])
+
+        final_prompt = render_prompt(template, prompt_context)
 
     else:
-        return jsonify({"error": "Invalid action"}), 400
+        invalid_action = True
+
+    # Wait for the auth check before answering or spending an inference call.
+    try:
+        if auth_job is not None:
+            user_exists = auth_job.get()
+            if isinstance(user_exists, Exception):
+                raise user_exists
 
+        if not user_exists:
+            return json_response({"error": "Unauthorized user"}, 403)
 
-    headers = {
-        "Authorization": f"Bearer {INFERENCE_KEY}",
-        "Content-Type": "application/json"
-    }
+    except Exception as e:
+        if not recently_authorized(user):
+            logger.exception("Auth API failure")
+            return json_response({"error": "Auth API failure", "details": str(e)}, 500)
+        logger.warning("Auth API failure, using recent auth result for %s: %s", user, e)
 
-    ai_payload = {
-        "model": INFERENCE_MODEL_ID,
-        "messages": [
-            {"role": "user", "content": final_prompt}
-        ]
-    }
+    if invalid_action:
+        return json_response({"error": "Invalid action"}, 400)
+
+    cache_key = response_cache_key(user, action, system_prompt, final_prompt)
+    cached_output = get_cached_response(cache_key)
+    if cached_output is not None:
+        logger.info("Response cache hit for %s", country_code)
+        return json_response({"raw": {"response": cached_output}}, 200)
+
+    ai_body = build_inference_body(system_prompt, final_prompt, action)
 
     try:
         logger.info("Calling inference API for %s", country_code)
 
-        r = requests.post(
-            f"{INFERENCE_URL}/v1/chat/completions",
-            json=ai_payload,
-            headers=headers,
-            timeout=20
+        r = HTTP.post(
+            INFERENCE_ENDPOINT,
+            data=ai_body,
+            headers=INFERENCE_HEADERS,
+            timeout=(CONNECT_TIMEOUT, 20)
         )
 
         r.raise_for_status()
 
-        ai_data = r.json()
+        ai_data = orjson.loads(r.content)
         output = ai_data["choices"][0]["message"]["content"]
 
         output = output.strip()
-        output = re.sub(r"^(As an AI|I'm an AI|I am an AI).*?\s*", "", output, flags=re.I)
-        output = re.sub(r'@\(([^)]+)\)', r'@\1', output)
-
-        emoji_pattern = re.compile(
-            "["u"\U0001F600-\U0001F64F"
-            u"\U0001F300-\U0001F5FF"
-            u"\U0001F680-\U0001F6FF"
-            u"\U0001F1E0-\U0001F1FF"
-            u"\u2600-\u26FF\u2700-\u27BF"
-            "]+",
-            flags=re.UNICODE
-        )
+        # Replies end up capped at 200 chars; don't run the cleanup passes over a runaway completion.
+        if len(output) > RAW_OUTPUT_LIMIT:
+            output = output[:RAW_OUTPUT_LIMIT]
+        output = AI_DISCLAIMER_RE.sub("", output)
+        output = PAREN_MENTION_RE.sub(r'@\1', output)
 
-        output = emoji_pattern.sub("", output)
+        output = EMOJI_RE.sub("", output)
         output = output.replace("\uFE0F", "")
         output = output.replace("/", "")
         output = output.replace("?", "")
@@ -643,13 +916,13 @@ def handle_country_request(country_code):
                 if not stripped:
                     continue
                 # remove lines that explicitly reference moderators
-                if re.search(r'\[MODERATOR\]|\bmoderator\b|\bmod\b', stripped, flags=re.I):
+                if MODERATOR_LINE_RE.search(stripped):
                     continue
                 # remove lines that start with "ai" or "ai:" etc (raw model tag)
-                if re.search(r'^\s*ai[:\s]', stripped, flags=re.I):
+                if AI_TAG_LINE_RE.search(stripped):
                     continue
                 # remove lines that contain 'command' plus a time-ref (e.g., "last night", "yesterday")
-                if re.search(r'\bcommand\b', stripped, flags=re.I) and re.search(r'\blast night\b|\byesterday\b|\bthis morning\b|\btoday\b', stripped, flags=re.I):
+                if COMMAND_RE.search(stripped) and TIME_REF_RE.search(stripped):
                     continue
                 filtered.append(stripped)
             output = "\n".join(filtered).strip()
@@ -658,19 +931,34 @@ def handle_country_request(country_code):
         # ----------------------------------------------------------------------------------------------------
 
         if len(output) > 200:
-            output = output[:197] + "..."
+            output = f"{output[:197]}..."
 
-        return jsonify({"raw": {"response": output}}), 200
+        store_cached_response(cache_key, output)
+        return json_response({"raw": {"response": output}}, 200)
 
     except Exception as e:
         logger.exception("Inference API failure")
-        return jsonify({"error": "Inference API failure", "details": str(e)}), 500
+        return json_response({"error": "Inference API failure", "details": str(e)}, 500)
+
+
+HOME_PAGE = "Server Active. Use country codes like /us, /in, /pk, /de for API access.".encode("utf-8")
+HOME_ETAG = hashlib.blake2b(HOME_PAGE, digest_size=8).hexdigest()
 
 
 @app.route("/", methods=["GET"])
 def home():
-    return "Server Active. Use country codes like /us, /in, /pk, /de for API access."
+    response = Response(
+        HOME_PAGE,
+        mimetype="text/html",
+        headers={"Cache-Control": "public, max-age=3600"}
+    )
+    response.set_etag(HOME_ETAG)
+    return response.make_conditional(request)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
+    from gevent.pywsgi import WSGIServer
+
+    port = int(os.getenv("PORT", 5000))
+    logger.info("Serving on 0.0.0.0:%s (gevent)", port)
+    WSGIServer(("0.0.0.0", port), app).serve_forever()